@@ -6,115 +6,278 @@ import signal
 import atexit
 import webbrowser
 import json
-import uuid
-from urllib.request import urlopen
-from urllib.error import URLError
+import re
+import secrets
+import http.client
+import pathlib
+import argparse
+import select
 
 # Chrome可执行文件路径
 CHROME_PATH = r"C:\Program Files\Google\Chrome\Application\chrome.exe"
 # 远程调试端口
 DEBUG_PORT = 14550
 # 用户数据目录
-USER_DATA_DIR = os.path.join(os.path.expanduser("~"), "chrome-remote-profile")
+USER_DATA_DIR = os.fspath(pathlib.Path.home() / "chrome-remote-profile")
+# Chrome启动命令
+CHROME_CMD = [
+    CHROME_PATH,
+    f"--remote-debugging-port={DEBUG_PORT}",
+    f"--user-data-dir={USER_DATA_DIR}",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--start-maximized"
+]
+
+# 端点选项菜单: (命令行选项名, 显示名称, URL模板)，URL模板为None表示该选项不是独立端点
+# 除第一项外均为高级选项，需通过 --advanced 显示
+ENDPOINT_MENU = (
+    ("standard", "标准 WebSocket URL (带有 /devtools/browser/)", "{ws}"),
+    ("http", "HTTP URL", "http://localhost:{port}"),
+    ("ws-debug", "不包含 devtools/browser 的 WebSocket URL", "ws://localhost:{port}/debug/{rid}"),
+    ("failure-sim", "启用故障模拟 (使用HTTP端点，每30秒断开连接5秒)", None),
+)
+ENDPOINT_CHOICES = tuple(key for key, _, _ in ENDPOINT_MENU)
+
+# 从 /json/version 响应中提取WebSocket端点；含转义字符的值交由JSON解析处理
+WEBSOCKET_URL_PATTERN = re.compile(rb'"webSocketDebuggerUrl"\s*:\s*"([^"\\]+)"')
+
+# 复用到Chrome远程调试API的HTTP连接（keep-alive），避免每次探测重新握手
+_http = http.client.HTTPConnection("localhost", DEBUG_PORT, timeout=1.0)
+# 当前运行的Chrome进程，故障模拟重启后会更新，供退出清理使用
+_chrome_process = None
+
+# 单次响应读取上限，/json/version 通常只有几百字节
+MAX_RESPONSE_SIZE = 8192
+
+def http_get(path):
+    """通过复用的连接发送GET请求，返回 (状态码, 响应体, 是否被截断)，响应体最多读取MAX_RESPONSE_SIZE字节"""
+    try:
+        _http.request("GET", path)
+        response = _http.getresponse()
+        body = response.read(MAX_RESPONSE_SIZE)
+        truncated = not response.isclosed()
+        if truncated:
+            # 响应超出上限，剩余数据无法在该连接上继续复用
+            _http.close()
+        return response.status, body, truncated
+    except (OSError, http.client.HTTPException):
+        # 连接失效（如Chrome重启），关闭后下次请求会自动重新连接
+        _http.close()
+        raise
+
+def write_block(text):
+    """一次性写出多行文本并刷新，避免多次print逐行加锁和刷新"""
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def launch_chrome():
+    """以远程调试参数启动Chrome进程，不继承父进程的标准输入输出和文件描述符"""
+    # 放入独立进程组，便于一并结束Chrome的所有子进程，也避免Ctrl+C同时传递给Chrome与退出清理产生竞争
+    kwargs = {}
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    return subprocess.Popen(
+        CHROME_CMD,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        **kwargs
+    )
+
+def terminate_chrome(process):
+    """结束Chrome及其全部子进程，避免残留的辅助进程占用用户数据目录"""
+    if os.name == "nt":
+        # taskkill /T 依赖主进程查找子进程树，主进程已退出时无法处理，且PID可能已被复用
+        if process.poll() is not None:
+            return
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        return
+    
+    # 进程组ID即主进程PID；即使主进程已退出，组内残留的辅助进程也需要结束
+    pgid = process.pid
+    deadline = time.monotonic() + 5
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    
+    if wait_for_exit(process, timeout=5):
+        # 主进程已退出，在剩余时间内等待辅助进程自行退出，避免写入用户数据时被强制结束
+        while time.monotonic() < deadline:
+            try:
+                os.killpg(pgid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.1)
+    
+    # 超时后强制结束仍存活的进程（包括忽略SIGTERM的辅助进程）
+    print("Chrome进程未能正常终止，强制结束")
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait(timeout=5)
 
 def start_chrome():
     """启动Chrome浏览器，开启远程调试模式"""
     print(f"启动Chrome，远程调试端口: {DEBUG_PORT}")
     
-    # 确保用户数据目录存在
-    os.makedirs(USER_DATA_DIR, exist_ok=True)
-    
-    # 构建Chrome启动命令
-    cmd = [
-        CHROME_PATH,
-        f"--remote-debugging-port={DEBUG_PORT}",
-        f"--user-data-dir={USER_DATA_DIR}",
-        "--no-first-run",
-        "--no-default-browser-check",
-        "--start-maximized"
-    ]
+    global _chrome_process
     
     # 启动Chrome进程
-    process = subprocess.Popen(cmd)
+    process = launch_chrome()
+    _chrome_process = process
     
-    # 注册退出处理函数，确保脚本退出时关闭Chrome
+    # 注册退出处理函数，确保脚本退出时关闭Chrome（包括故障模拟重启后的进程）
     def cleanup():
-        if process.poll() is None:
+        if _chrome_process is None:
+            return
+        if _chrome_process.poll() is None:
             print("关闭Chrome...")
-            process.terminate()
-            try:
-                process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.kill()
+        terminate_chrome(_chrome_process)
     
     atexit.register(cleanup)
     
     # 等待Chrome启动
     print("等待Chrome启动...")
     print("请等待启动后展示浏览器远程地址...")
-    time.sleep(2)
     
     return process
 
-def get_websocket_endpoint():
-    """获取Chrome远程调试WebSocket端点"""
+def wait_for_exit(process, timeout=None):
+    """阻塞等待进程退出，进程已退出返回True，超时返回False"""
+    if os.name != "nt":
+        if process.poll() is not None:
+            return True
+        try:
+            # 等待pidfd可读，进程退出前不会唤醒解释器
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            # 不支持pidfd时退回到wait(timeout)，其内部为间隔最多50ms的轮询
+            try:
+                process.wait(timeout=timeout)
+                return True
+            except subprocess.TimeoutExpired:
+                return False
+        try:
+            ready, _, _ = select.select([pidfd], [], [], timeout)
+        finally:
+            os.close(pidfd)
+        if not ready:
+            return False
+        process.wait()
+        return True
+    
+    # Windows下长时间的wait()无法被Ctrl+C打断，分段等待
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = 1 if deadline is None else min(1, deadline - time.monotonic())
+        if remaining <= 0:
+            return False
+        try:
+            process.wait(timeout=remaining)
+            return True
+        except subprocess.TimeoutExpired:
+            pass
+
+def extract_websocket_url(body, truncated=False):
+    """从 /json/version 响应体中提取WebSocket端点，响应格式异常时返回None"""
     try:
-        # 尝试连接到Chrome远程调试API
-        response = urlopen(f"http://localhost:{DEBUG_PORT}/json/version")
-        data = json.loads(response.read().decode())
-        websocket_url = data.get("webSocketDebuggerUrl")
-        
-        if websocket_url:
-            print(f"WebSocket调试端点: {websocket_url}")
-            return websocket_url
-        else:
-            print("无法获取WebSocket调试端点")
+        match = WEBSOCKET_URL_PATTERN.search(body)
+        if match:
+            return match.group(1).decode()
+        # 响应体被截断时JSON不完整，无法回退解析
+        if truncated:
             return None
-    except URLError as e:
-        print(f"连接Chrome远程调试API失败: {e}")
+        # 正则未命中时回退到完整JSON解析
+        data = json.loads(body.decode())
+    except (ValueError, RecursionError):
+        # RecursionError: 深度嵌套的数组/对象会超出json解析的递归上限
+        return None
+    if not isinstance(data, dict):
         return None
+    websocket_url = data.get("webSocketDebuggerUrl")
+    return websocket_url if isinstance(websocket_url, str) else None
 
-def generate_endpoint_options(websocket_endpoint):
-    """生成不同的端点选项"""
-    options = []
-    
-    # 1. 标准WebSocket URL (带有 /devtools/browser/)
-    options.append(websocket_endpoint)
+def get_websocket_endpoint(timeout=10):
+    """轮询Chrome远程调试API，获取WebSocket端点（最多等待timeout秒）"""
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    last_error = None
     
-    # 2. HTTP URL
-    options.append(f"http://localhost:{DEBUG_PORT}")
-    
-    # 3. 不包含 devtools/browser 的 WebSocket URL
-    random_id = str(uuid.uuid4())[:8]
-    options.append(f"ws://localhost:{DEBUG_PORT}/debug/{random_id}")
+    while time.monotonic() < deadline:
+        try:
+            # 尝试连接到Chrome远程调试API
+            status, body, truncated = http_get("/json/version")
+            if status != 200:
+                raise http.client.HTTPException(f"HTTP {status}")
+            websocket_url = extract_websocket_url(body, truncated)
+            
+            if websocket_url:
+                print(f"WebSocket调试端点: {websocket_url}")
+                return websocket_url
+            else:
+                print("无法获取WebSocket调试端点")
+                return None
+        except (OSError, http.client.HTTPException) as e:
+            # Chrome尚未就绪，短暂退避后重试
+            last_error = e
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
     
-    return options
+    print(f"连接Chrome远程调试API失败: {last_error}")
+    return None
+
+def generate_endpoint_options(websocket_endpoint):
+    """按菜单生成各选项对应的端点"""
+    random_id = secrets.token_hex(4)
+    return [
+        template and template.format(ws=websocket_endpoint, port=DEBUG_PORT, rid=random_id)
+        for _, _, template in ENDPOINT_MENU
+    ]
 
-def display_endpoint_options(options):
-    """显示端点选项并让用户选择"""
+def display_endpoint_options(options, advanced=False):
+    """显示端点选项并让用户选择，返回所选项在ENDPOINT_MENU中的序号"""
+    # 未启用高级选项时只有标准端点可选，无需询问
+    if not advanced:
+        return 0
+    
     print("\n=== 请选择连接方式 ===")
-    print("1. 标准 WebSocket URL (带有 /devtools/browser/)")
-    print(f"   {options[0]}")
-    print("2. HTTP URL")
-    print(f"   {options[1]}")
-    print("3. 不包含 devtools/browser 的 WebSocket URL")
-    print(f"   {options[2]}")
-    print("4. 启用故障模拟 (使用HTTP端点，每30秒断开连接5秒)")
+    for i, ((_, label, _), endpoint) in enumerate(zip(ENDPOINT_MENU, options), 1):
+        print(f"{i}. {label}")
+        if endpoint:
+            print(f"   {endpoint}")
     
+    count = len(ENDPOINT_MENU)
     while True:
         try:
-            choice = int(input("\n请输入选项序号 (1-4): "))
-            if 1 <= choice <= 4:
+            choice = int(input(f"\n请输入选项序号 (1-{count}): "))
+            if 1 <= choice <= count:
                 return choice - 1
             else:
-                print("无效的选择，请输入 1-4 之间的数字")
+                print(f"无效的选择，请输入 1-{count} 之间的数字")
         except ValueError:
             print("请输入有效的数字")
+        except EOFError:
+            sys.exit("标准输入已关闭，请通过 --endpoint-choice 或环境变量 CHROME_ENDPOINT_CHOICE 指定选项")
 
 def simulate_failure_with_http(chrome_process):
     """使用HTTP端点模拟故障：每30秒断开连接5秒"""
-    print("\n=== 故障模拟模式已启动 (HTTP端点) ===")
-    print("每30秒将断开连接5秒")
+    global _chrome_process
+    
+    write_block("\n=== 故障模拟模式已启动 (HTTP端点) ===\n每30秒将断开连接5秒\n")
     
     # 使用固定的HTTP端点
     http_endpoint = f"http://localhost:{DEBUG_PORT}"
@@ -125,21 +288,13 @@ def simulate_failure_with_http(chrome_process):
             cycle_count += 1
             # 正常运行30秒
             print(f"\n[故障模拟] 周期 {cycle_count}: 正常运行30秒...")
-            for i in range(30):
-                if chrome_process.poll() is not None:
-                    print("Chrome进程已终止，退出故障模拟")
-                    return chrome_process
-                time.sleep(1)
+            if wait_for_exit(chrome_process, timeout=30):
+                print("Chrome进程已终止，退出故障模拟")
+                return chrome_process
                 
             print(f"[故障模拟] 周期 {cycle_count}: 断开连接5秒...")
-            # 终止Chrome进程
-            chrome_process.terminate()
-            try:
-                chrome_process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                print("Chrome进程未能正常终止，强制结束")
-                chrome_process.kill()
-                chrome_process.wait(timeout=5)
+            # 终止Chrome进程及其子进程
+            terminate_chrome(chrome_process)
             
             # 等待5秒
             time.sleep(5)
@@ -147,104 +302,119 @@ def simulate_failure_with_http(chrome_process):
             # 重新启动Chrome进程
             print(f"[故障模拟] 周期 {cycle_count}: 恢复连接...")
             try:
-                # 保存Chrome启动参数
-                cmd = [
-                    CHROME_PATH,
-                    f"--remote-debugging-port={DEBUG_PORT}",
-                    f"--user-data-dir={USER_DATA_DIR}",
-                    "--no-first-run",
-                    "--no-default-browser-check",
-                    "--start-maximized"
-                ]
-                chrome_process = subprocess.Popen(cmd)
+                chrome_process = launch_chrome()
+                # 重启后的进程同样需要在脚本退出时关闭
+                _chrome_process = chrome_process
             except Exception as e:
                 print(f"重启Chrome失败: {e}")
                 return chrome_process
             
-            # 等待Chrome重新启动
+            # 等待Chrome重新启动，确认HTTP端点可访问
             print("等待Chrome重新启动...")
-            time.sleep(3)
-            
-            # 尝试访问HTTP端点，确认Chrome已启动
-            try:
-                response = urlopen(http_endpoint + "/json/version")
-                if response.getcode() == 200:
-                    print(f"Chrome已重新启动，HTTP端点可访问: {http_endpoint}")
-                else:
-                    print(f"警告: HTTP端点返回状态码 {response.getcode()}")
-            except Exception as e:
-                print(f"警告: 无法访问HTTP端点: {e}")
+            if get_websocket_endpoint():
+                print(f"Chrome已重新启动，HTTP端点可访问: {http_endpoint}")
+            else:
+                print(f"警告: 无法访问HTTP端点: {http_endpoint}")
                 
     except KeyboardInterrupt:
         print("\n接收到中断信号，正在关闭...")
         
     return chrome_process
 
-def main():
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="启动Chrome远程调试服务，并输出Koishi远程浏览器配置")
+    parser.add_argument(
+        "--endpoint-choice",
+        choices=ENDPOINT_CHOICES,
+        default=os.environ.get("CHROME_ENDPOINT_CHOICE"),
+        help="直接指定连接方式，跳过交互选择（默认读取环境变量 CHROME_ENDPOINT_CHOICE）"
+    )
+    parser.add_argument(
+        "--advanced",
+        action="store_true",
+        help="在交互选择中显示非标准连接方式与故障模拟"
+    )
+    args = parser.parse_args(argv)
+    # argparse 不会按 choices 校验默认值，需单独校验来自环境变量的取值
+    if args.endpoint_choice is not None and args.endpoint_choice not in ENDPOINT_CHOICES:
+        parser.error(
+            f"环境变量 CHROME_ENDPOINT_CHOICE 无效: {args.endpoint_choice!r}"
+            f"（可选值: {', '.join(ENDPOINT_CHOICES)}）"
+        )
+    return args
+
+def main(argv=None):
     """主函数"""
+    args = parse_args(argv)
     print("启动Chrome远程调试服务...")
     
     # 检查Chrome是否存在
-    if not os.path.exists(CHROME_PATH):
+    if not os.path.isfile(CHROME_PATH):
         print(f"错误: Chrome可执行文件未找到: {CHROME_PATH}")
         sys.exit(1)
     
+    # 确保用户数据目录存在
+    pathlib.Path(USER_DATA_DIR).mkdir(exist_ok=True)
+    
     # 启动Chrome
     chrome_process = start_chrome()
     
-    # 等待Chrome完全启动
-    time.sleep(3)
-    
-    # 获取WebSocket端点
+    # 等待Chrome完全启动并获取WebSocket端点
     websocket_endpoint = get_websocket_endpoint()
     
     if websocket_endpoint:
         # 生成不同的端点选项
         endpoint_options = generate_endpoint_options(websocket_endpoint)
         
-        # 显示选项并获取用户选择
-        selected_index = display_endpoint_options(endpoint_options)
+        # 命令行未指定时，显示选项并获取用户选择
+        if args.endpoint_choice:
+            selected_index = ENDPOINT_CHOICES.index(args.endpoint_choice)
+        else:
+            selected_index = display_endpoint_options(endpoint_options, args.advanced)
         
         # 故障模拟模式
-        if selected_index == 3:
+        if ENDPOINT_CHOICES[selected_index] == "failure-sim":
             # 使用HTTP URL
-            selected_endpoint = endpoint_options[1]  # HTTP URL
-            print("\n=== 已选择故障模拟模式 ===")
-            print(f"远程浏览器端点: {selected_endpoint}")
-            
-            print("\n在Koishi配置中使用:")
-            print(f"""{{
+            selected_endpoint = endpoint_options[ENDPOINT_CHOICES.index("http")]
+            write_block(f"""
+=== 已选择故障模拟模式 ===
+远程浏览器端点: {selected_endpoint}
+
+在Koishi配置中使用:
+{{
   "remote": true,
   "endpoint": "{selected_endpoint}",
   "enableReconnect": true,
   "reconnectInterval": 1000
-}}""")
-            
-            print("\n按Ctrl+C停止服务...")
+}}
+
+按Ctrl+C停止服务...
+""")
             chrome_process = simulate_failure_with_http(chrome_process)
         else:
             # 正常模式
             selected_endpoint = endpoint_options[selected_index]
             
-            print("\n=== 已选择的连接信息 ===")
-            print(f"远程浏览器端点: {selected_endpoint}")
+            # 如果选择了非标准选项，添加提示
+            notice = "\n注意: 你选择了非标准连接方式，这可能不会正常工作。\n" if selected_index > 0 else ""
             
-            print("\n在Koishi配置中使用:")
-            print(f"""{{
+            write_block(f"""
+=== 已选择的连接信息 ===
+远程浏览器端点: {selected_endpoint}
+
+在Koishi配置中使用:
+{{
   "remote": true,
   "endpoint": "{selected_endpoint}"
-}}""")
-            
-            # 如果选择了非标准选项，添加提示
-            if selected_index > 0:
-                print("\n注意: 你选择了非标准连接方式，这可能不会正常工作。")
-            
-            print("\n按Ctrl+C停止服务...")
+}}
+{notice}
+按Ctrl+C停止服务...
+""")
             
             try:
-                # 保持脚本运行
-                while chrome_process.poll() is None:
-                    time.sleep(1)
+                # 保持脚本运行，阻塞等待Chrome退出
+                wait_for_exit(chrome_process)
             except KeyboardInterrupt:
                 print("\n接收到中断信号，正在关闭...")
     else: